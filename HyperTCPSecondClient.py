@@ -3,11 +3,11 @@
 Second client for testing device-to-device communication in HyperTCP protocol
 """
 
+import selectors
 import socket
 import struct
 import json
 import time
-import threading
 
 # Protocol definitions (HyperTCP)
 HYPER_TCP_CMD_RESPONSE      = 0
@@ -42,6 +42,7 @@ class HyperTCPSecondClient:
         self.port = port
         self.device_id = device_id or f"actuator_device_{int(time.time() * 1000) % 100000}"
         self.socket = None
+        self._selector = None
         self.connected = False
         self.message_id = 1
         self.running = False
@@ -81,8 +82,8 @@ class HyperTCPSecondClient:
                     elif response['type'] == HYPER_TCP_CMD_JSON_MESSAGE:
                         # This might be the welcome message
                         try:
-                            json_data = response['payload'].decode('utf-8')
-                            welcome_data = json.loads(json_data)
+                            # json.loads decodes UTF-8 bytes itself
+                            welcome_data = json.loads(response['payload'])
                             print(f"Received welcome message: {welcome_data.get('payload', {})}")
                             welcome_message_received = True
                         except Exception as e:
@@ -94,10 +95,10 @@ class HyperTCPSecondClient:
                 if authenticated:
                     self.running = True
                     
-                    # Start receiving thread
-                    receive_thread = threading.Thread(target=self.receive_loop)
-                    receive_thread.daemon = True
-                    receive_thread.start()
+                    # poll() waits on this selector and handles each readable
+                    # event on the caller's thread
+                    self._selector = selectors.DefaultSelector()
+                    self._selector.register(self.socket, selectors.EVENT_READ, self._on_readable)
                     
                     return True
                 else:
@@ -115,6 +116,9 @@ class HyperTCPSecondClient:
         """Disconnect from the server"""
         self.running = False
         self.connected = False
+        if self._selector:
+            self._selector.close()
+            self._selector = None
         if self.socket:
             self.socket.close()
     
@@ -227,22 +231,31 @@ class HyperTCPSecondClient:
             print(f"Error receiving message: {e}")
             return None
     
-    def receive_loop(self):
-        """Continuously receive messages from the server"""
+    def poll(self, timeout):
+        """Dispatch messages from the server for up to 'timeout' seconds"""
+        deadline = time.monotonic() + timeout
         while self.running and self.connected:
-            try:
-                message = self.receive_message()
-                if message:
-                    self.handle_message(message)
-                else:
-                    # Connection closed
-                    self.connected = False
-                    self.running = False
-                    break
-            except Exception as e:
-                if self.running:
-                    print(f"Error in receive loop: {e}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 break
+            for key, _ in self._selector.select(remaining):
+                key.data()
+    
+    def _on_readable(self):
+        """Receive and handle one message once the socket is readable"""
+        try:
+            message = self.receive_message()
+            if message:
+                self.handle_message(message)
+            else:
+                # Connection closed
+                self.connected = False
+                self.running = False
+        except Exception as e:
+            if self.running:
+                print(f"Error handling incoming message: {e}")
+            self.connected = False
+            self.running = False
     
     def handle_message(self, message):
         """Handle received messages"""
@@ -258,8 +271,7 @@ class HyperTCPSecondClient:
         
         elif msg_type == HYPER_TCP_CMD_JSON_MESSAGE:
             try:
-                json_data = payload.decode('utf-8')
-                msg = json.loads(json_data)
+                msg = json.loads(payload)
                 print(f"Received JSON message (ID: {msg_id}):")
                 print(f"  From: {msg.get('from', 'unknown')}")
                 print(f"  Payload: {msg.get('payload', {})}")
@@ -275,8 +287,7 @@ class HyperTCPSecondClient:
         
         elif msg_type == HYPER_TCP_CMD_BROADCAST:
             try:
-                json_data = payload.decode('utf-8')
-                msg = json.loads(json_data)
+                msg = json.loads(payload)
                 print(f"Received broadcast message (ID: {msg_id}):")
                 print(f"  From: {msg.get('from', 'unknown')}")
                 print(f"  Payload: {msg.get('payload', {})}")
@@ -315,13 +326,16 @@ class HyperTCPSecondClient:
         # For now, we'll just print that we received the command
         
     def recv_all(self, length):
-        """Receive exactly 'length' bytes from socket"""
-        data = b''
-        while len(data) < length:
-            packet = self.socket.recv(length - len(data))
-            if not packet:
+        """Receive exactly 'length' bytes from socket into a bytearray"""
+        # Each recv_into() fills the next part of one preallocated buffer
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            count = self.socket.recv_into(view[received:])
+            if not count:
                 return None
-            data += packet
+            received += count
         return data
 
 def main():
@@ -364,7 +378,8 @@ def main():
                 print("Sent ping")
             
             counter += 1
-            time.sleep(1)
+            # Handle incoming messages while waiting for the next tick
+            client.poll(1)
             
     except KeyboardInterrupt:
         print("Shutting down client...")
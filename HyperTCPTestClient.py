@@ -2,13 +2,29 @@
 """
 Simple TCP client for testing the HyperTCP protocol
 This client can be used to test communication with the HyperTCP server
+It runs on asyncio, so one event loop can drive many client connections
 """
 
+import asyncio
+import heapq
 import socket
 import struct
 import json
 import time
-import threading
+from collections import namedtuple
+
+# Prefer orjson for the wire JSON: it serializes straight to bytes and parses
+# bytes without an intermediate str. Fall back to the stdlib if unavailable.
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    _json_loads = json.loads
 
 # Protocol definitions (HyperTCP)
 HYPER_TCP_CMD_RESPONSE      = 0
@@ -23,39 +39,52 @@ HYPER_TCP_STATUS_INVALID_TOKEN     = 9
 HYPER_TCP_STATUS_NOT_AUTHENTICATED = 5
 HYPER_TCP_STATUS_TIMEOUT           = 16
 
-class HyperTCPHeader:
-    def __init__(self, type=0, msg_id=0, length=0):
-        self.type = type
-        self.msg_id = msg_id
-        self.length = length
-    
-    def pack(self):
-        return struct.pack('!BHH', self.type, self.msg_id, self.length)
-    
-    @classmethod
-    def unpack(cls, data):
-        type, msg_id, length = struct.unpack('!BHH', data)
-        return cls(type, msg_id, length)
+# Serialized start of every broadcast message; only the payload varies
+_BROADCAST_PREFIX = b'{"targetId":"broadcast","payload":'
+
+# Kernel send/receive buffer size requested for the client socket
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# Header layout: type (1 byte), message id (2 bytes), payload length (2 bytes)
+_HDR = struct.Struct('!BHH')
+_pack_header = _HDR.pack
+
+# A received message: header fields and payload bytes
+Msg = namedtuple('Msg', 'type msg_id length payload')
 
 class HyperTCPClient:
-    def __init__(self, host='localhost', port=8080, device_id=None):
+    def __init__(self, host='localhost', port=8080, device_id=None, unix_path=None):
         self.host = host
         self.port = port
+        self.unix_path = unix_path  # Connect over this Unix socket instead of TCP
         self.device_id = device_id or f"device_{int(time.time() * 1000) % 100000}"
-        self.socket = None
+        self._reader = None
+        self._writer = None
+        self._receive_task = None
         self.connected = False
         self.message_id = 1
         self.running = False
+        # Serialized '{"targetId":...,"payload":' prefixes by target ID
+        self._target_prefixes = {}
+        # Message type -> handler(msg_id, payload)
+        self._handlers = {
+            HYPER_TCP_CMD_RESPONSE: self._handle_response,
+            HYPER_TCP_CMD_JSON_MESSAGE: self._handle_json,
+            HYPER_TCP_CMD_BROADCAST: self._handle_broadcast,
+            HYPER_TCP_CMD_PING: self._handle_ping,
+        }
 
-    def connect(self, token="your_auth_token_here"):
+    async def connect(self, token="your_auth_token_here"):
         """Connect to the HyperTCP server and authenticate"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
+            if self.unix_path:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.unix_path)
+            else:
+                await self._open_tcp_connection()
             self.connected = True
             
             # Send login command with device ID
-            if self.send_login(token, self.device_id):
+            if await self.send_login(token, self.device_id):
                 # Wait for messages and handle them appropriately
                 login_response_received = False
                 welcome_message_received = False
@@ -63,14 +92,14 @@ class HyperTCPClient:
                 
                 # We might receive multiple messages, so we'll loop until we get the login response
                 while not login_response_received:
-                    response = self.receive_message()
+                    response = await self.receive_message()
                     if not response:
                         print("No response received from server")
                         return False
                     
-                    if response['type'] == HYPER_TCP_CMD_RESPONSE:
+                    if response.type == HYPER_TCP_CMD_RESPONSE:
                         # This is the login response
-                        status = response['payload'][0] if response['payload'] else 0
+                        status = response.payload[0] if response.payload else 0
                         if status == HYPER_TCP_STATUS_SUCCESS:
                             print(f"Authentication successful for device {self.device_id}")
                             authenticated = True
@@ -79,26 +108,23 @@ class HyperTCPClient:
                             return False
                         login_response_received = True
                         
-                    elif response['type'] == HYPER_TCP_CMD_JSON_MESSAGE:
+                    elif response.type == HYPER_TCP_CMD_JSON_MESSAGE:
                         # This might be the welcome message
                         try:
-                            json_data = response['payload'].decode('utf-8')
-                            welcome_data = json.loads(json_data)
+                            welcome_data = _json_loads(response.payload)
                             print(f"Received welcome message: {welcome_data.get('payload', {})}")
                             welcome_message_received = True
                         except Exception as e:
                             print(f"Error parsing message: {e}")
                             
                     else:
-                        print(f"Received unexpected message type: {response['type']}")
+                        print(f"Received unexpected message type: {response.type}")
                 
                 if authenticated:
                     self.running = True
                     
-                    # Start receiving thread
-                    receive_thread = threading.Thread(target=self.receive_loop)
-                    receive_thread.daemon = True
-                    receive_thread.start()
+                    # Start receiving task
+                    self._receive_task = asyncio.create_task(self.receive_loop())
                     
                     return True
                 else:
@@ -112,14 +138,36 @@ class HyperTCPClient:
             self.connected = False
             return False
     
-    def disconnect(self):
+    async def _open_tcp_connection(self):
+        """Open a tuned TCP connection and wrap it in asyncio streams"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Small request/response messages: don't let Nagle hold them back.
+        # Buffers are sized before connect() so the window scale covers them.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, (self.host, self.port))
+        except BaseException:
+            sock.close()
+            raise
+        self._reader, self._writer = await asyncio.open_connection(sock=sock)
+    
+    async def disconnect(self):
         """Disconnect from the server"""
         self.running = False
         self.connected = False
-        if self.socket:
-            self.socket.close()
+        if self._receive_task and self._receive_task is not asyncio.current_task():
+            self._receive_task.cancel()
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
     
-    def send_login(self, token, device_id=None):
+    async def send_login(self, token, device_id=None):
         """Send login command to server with device ID"""
         try:
             # Create login data with token and device_id
@@ -129,110 +177,95 @@ class HyperTCPClient:
             }
             
             # Serialize to JSON
-            json_data = json.dumps(login_data)
-            payload_bytes = json_data.encode('utf-8')
+            payload_bytes = _json_dumps(login_data)
             
-            header = HyperTCPHeader(HYPER_TCP_CMD_LOGIN, 1, len(payload_bytes))
+            header = _pack_header(HYPER_TCP_CMD_LOGIN, 1, len(payload_bytes))
             
-            self.socket.send(header.pack())
-            self.socket.send(payload_bytes)
+            await self._send_frame(header, payload_bytes)
             return True
         except Exception as e:
             print(f"Error sending login: {e}")
             return False
     
-    def send_message(self, target_id, payload):
+    async def send_message(self, target_id, payload):
         """Send a JSON message to a specific target"""
         try:
-            # Create message
-            message = {
-                "targetId": target_id,
-                "payload": payload
-            }
-            
-            # Serialize to JSON
-            json_data = json.dumps(message)
-            payload_bytes = json_data.encode('utf-8')
+            # Serialize only the payload; the targetId part is cached per target
+            prefix = self._target_prefixes.get(target_id)
+            if prefix is None:
+                prefix = b'{"targetId":' + _json_dumps(target_id) + b',"payload":'
+                self._target_prefixes[target_id] = prefix
+            payload_bytes = prefix + _json_dumps(payload) + b'}'
             
             # Send message
-            header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, self.message_id, len(payload_bytes))
+            header = _pack_header(HYPER_TCP_CMD_JSON_MESSAGE, self.message_id, len(payload_bytes))
             self.message_id += 1
             
-            self.socket.send(header.pack())
-            self.socket.send(payload_bytes)
+            await self._send_frame(header, payload_bytes)
             return True
         except Exception as e:
             print(f"Error sending message: {e}")
             return False
     
-    def broadcast_message(self, payload):
+    async def broadcast_message(self, payload):
         """Send a broadcast message to all clients"""
         try:
-            # Create message
-            message = {
-                "targetId": "broadcast",
-                "payload": payload
-            }
-            
-            # Serialize to JSON
-            json_data = json.dumps(message)
-            payload_bytes = json_data.encode('utf-8')
+            # Serialize only the payload behind the constant broadcast prefix
+            payload_bytes = _BROADCAST_PREFIX + _json_dumps(payload) + b'}'
             
             # Send broadcast
-            header = HyperTCPHeader(HYPER_TCP_CMD_BROADCAST, self.message_id, len(payload_bytes))
+            header = _pack_header(HYPER_TCP_CMD_BROADCAST, self.message_id, len(payload_bytes))
             self.message_id += 1
             
-            self.socket.send(header.pack())
-            self.socket.send(payload_bytes)
+            await self._send_frame(header, payload_bytes)
             return True
         except Exception as e:
             print(f"Error sending broadcast: {e}")
             return False
     
-    def send_ping(self):
+    async def send_ping(self):
         """Send a ping to the server"""
         try:
-            header = HyperTCPHeader(HYPER_TCP_CMD_PING, self.message_id, 0)
+            header = _pack_header(HYPER_TCP_CMD_PING, self.message_id, 0)
             self.message_id += 1
             
-            self.socket.send(header.pack())
+            await self._send_frame(header)
             return True
         except Exception as e:
             print(f"Error sending ping: {e}")
             return False
     
-    def receive_message(self):
+    async def _send_frame(self, header, payload=b''):
+        """Send header and payload as one frame"""
+        # writelines hands the transport both buffers at once, so the frame
+        # goes out in a single send
+        self._writer.writelines((header, payload))
+        await self._writer.drain()
+    
+    async def receive_message(self):
         """Receive a single message from the server"""
         try:
-            # Read header (5 bytes)
-            header_data = self.recv_all(5)
-            if not header_data or len(header_data) < 5:
-                return None
+            # Read header (5 bytes); readexactly waits out short reads for us
+            header_data = await self._reader.readexactly(_HDR.size)
             
-            header = HyperTCPHeader.unpack(header_data)
+            msg_type, msg_id, length = _HDR.unpack_from(header_data)
             
             # Read payload if any
-            payload = b''
-            if header.length > 0:
-                payload = self.recv_all(header.length)
-                if not payload:
-                    return None
+            payload = await self._reader.readexactly(length) if length else b''
             
-            return {
-                'type': header.type,
-                'msg_id': header.msg_id,
-                'length': header.length,
-                'payload': payload
-            }
+            return Msg(msg_type, msg_id, length, payload)
+        except asyncio.IncompleteReadError:
+            # Connection closed
+            return None
         except Exception as e:
             print(f"Error receiving message: {e}")
             return None
     
-    def receive_loop(self):
+    async def receive_loop(self):
         """Continuously receive messages from the server"""
         while self.running and self.connected:
             try:
-                message = self.receive_message()
+                message = await self.receive_message()
                 if message:
                     self.handle_message(message)
                 else:
@@ -247,62 +280,53 @@ class HyperTCPClient:
     
     def handle_message(self, message):
         """Handle received messages"""
-        msg_type = message['type']
-        msg_id = message['msg_id']
-        payload = message['payload']
-        
-        if msg_type == HYPER_TCP_CMD_RESPONSE:
-            print(f"Received response (ID: {msg_id})")
-            if len(payload) == 1:
-                status = payload[0]
-                print(f"  Status: {status}")
-        
-        elif msg_type == HYPER_TCP_CMD_JSON_MESSAGE:
-            try:
-                json_data = payload.decode('utf-8')
-                msg = json.loads(json_data)
-                print(f"Received JSON message (ID: {msg_id}):")
-                print(f"  From: {msg.get('from', 'unknown')}")
-                print(f"  Payload: {msg.get('payload', {})}")
-            except Exception as e:
-                print(f"Error parsing JSON message: {e}")
+        msg_type = message.type
+        msg_id = message.msg_id
+        payload = message.payload
         
-        elif msg_type == HYPER_TCP_CMD_BROADCAST:
-            try:
-                json_data = payload.decode('utf-8')
-                msg = json.loads(json_data)
-                print(f"Received broadcast message (ID: {msg_id}):")
-                print(f"  From: {msg.get('from', 'unknown')}")
-                print(f"  Payload: {msg.get('payload', {})}")
-            except Exception as e:
-                print(f"Error parsing broadcast message: {e}")
-        
-        elif msg_type == HYPER_TCP_CMD_PING:
-            print(f"Received ping (ID: {msg_id})")
-            # Send pong response
-            response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, msg_id, 0)
-            self.socket.send(response_header.pack())
-        
-        else:
+        handler = self._handlers.get(msg_type)
+        if handler is None:
             print(f"Received unknown message type: {msg_type} (ID: {msg_id})")
+        else:
+            handler(msg_id, payload)
+    
+    def _handle_response(self, msg_id, payload):
+        print(f"Received response (ID: {msg_id})")
+        if len(payload) == 1:
+            status = payload[0]
+            print(f"  Status: {status}")
     
-    def recv_all(self, length):
-        """Receive exactly 'length' bytes from socket"""
-        data = b''
-        while len(data) < length:
-            packet = self.socket.recv(length - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+    def _handle_json(self, msg_id, payload):
+        try:
+            msg = _json_loads(payload)
+            print(f"Received JSON message (ID: {msg_id}):")
+            print(f"  From: {msg.get('from', 'unknown')}")
+            print(f"  Payload: {msg.get('payload', {})}")
+        except Exception as e:
+            print(f"Error parsing JSON message: {e}")
+    
+    def _handle_broadcast(self, msg_id, payload):
+        try:
+            msg = _json_loads(payload)
+            print(f"Received broadcast message (ID: {msg_id}):")
+            print(f"  From: {msg.get('from', 'unknown')}")
+            print(f"  Payload: {msg.get('payload', {})}")
+        except Exception as e:
+            print(f"Error parsing broadcast message: {e}")
+    
+    def _handle_ping(self, msg_id, payload):
+        print(f"Received ping (ID: {msg_id})")
+        # Send pong response
+        # Header-only reply; the transport buffers it, no need to wait
+        self._writer.write(_pack_header(HYPER_TCP_CMD_RESPONSE, msg_id, 0))
 
-def main():
+async def main():
     """Main function for testing the HyperTCP client"""
     # Create client with a specific device ID
     client = HyperTCPClient('localhost', 8080, "sensor_device_001")
     
     # Connect to server
-    if not client.connect("your_auth_token_here"):
+    if not await client.connect("your_auth_token_here"):
         print("Failed to connect to server")
         return
     
@@ -314,44 +338,63 @@ def main():
             "command": "welcome",
             "message": f"Hello from {client.device_id}"
         }
-        client.send_message("server", welcome_payload)
+        await client.send_message("server", welcome_payload)
+        
+        device_id = client.device_id
         
-        # Send periodic messages
-        counter = 0
+        # Periodic messages; 'elapsed' is whole seconds since the loop started
+        async def send_sensor_data(elapsed, now_ms):
+            sensor_payload = {
+                "command": "sensor_data",
+                "temperature": 20 + (elapsed % 10),
+                "humidity": 50 + (elapsed % 20),
+                "timestamp": now_ms
+            }
+            await client.send_message("server", sensor_payload)
+            print(f"Sent sensor data: {sensor_payload}")
+        
+        async def send_ping(elapsed, now_ms):
+            await client.send_ping()
+            print("Sent ping")
+        
+        async def send_notification(elapsed, now_ms):
+            broadcast_payload = {
+                "command": "notification",
+                "message": f"System notification #{elapsed//30} from {device_id}",
+                "timestamp": now_ms
+            }
+            await client.broadcast_message(broadcast_payload)
+            print(f"Sent broadcast: {broadcast_payload}")
+        
+        # Deadline heap of (due time, order, interval, action); the loop
+        # sleeps until the earliest event is due
+        start = time.monotonic()
+        events = [
+            (start, 0, 5, send_sensor_data),        # every 5 seconds
+            (start + 5, 1, 10, send_ping),          # every 10 seconds
+            (start + 15, 2, 30, send_notification)  # every 30 seconds
+        ]
+        heapq.heapify(events)
         while client.connected:
-            # Send sensor data every 5 seconds
-            if counter % 5 == 0:
-                sensor_payload = {
-                    "command": "sensor_data",
-                    "temperature": 20 + (counter % 10),
-                    "humidity": 50 + (counter % 20),
-                    "timestamp": int(time.time() * 1000)
-                }
-                client.send_message("server", sensor_payload)
-                print(f"Sent sensor data: {sensor_payload}")
-            
-            # Send ping every 10 seconds
-            if counter % 10 == 5:
-                client.send_ping()
-                print("Sent ping")
-            
-            # Send broadcast every 30 seconds
-            if counter % 30 == 15:
-                broadcast_payload = {
-                    "command": "notification",
-                    "message": f"System notification #{counter//30} from {client.device_id}",
-                    "timestamp": int(time.time() * 1000)
-                }
-                client.broadcast_message(broadcast_payload)
-                print(f"Sent broadcast: {broadcast_payload}")
+            delay = events[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if not client.connected:
+                    break
             
-            counter += 1
-            time.sleep(1)
+            # Run everything due now with one shared timestamp
+            now = time.monotonic()
+            now_ms = int(time.time() * 1000)
+            while events[0][0] <= now:
+                due, order, interval, action = heapq.heappop(events)
+                await action(round(due - start), now_ms)
+                heapq.heappush(events, (due + interval, order, interval, action))
             
-    except KeyboardInterrupt:
-        print("Shutting down client...")
     finally:
-        client.disconnect()
+        await client.disconnect()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Shutting down client...")
@@ -2,15 +2,41 @@
 """
 Simple server implementation for testing the HyperTCP protocol
 Pure TCP implementation without WebSocket or any other protocol
+Each connection is a HyperTCPConnection protocol on one asyncio event loop
 """
 
+import asyncio
+import errno
+import logging
+import logging.handlers
+import os
+import queue
 import socket
 import struct
-import threading
 import json
+import sys
 import time
 from collections import defaultdict
 
+# Prefer orjson for the wire JSON: it serializes straight to bytes and parses
+# bytes (or a memoryview of the receive buffer) without an intermediate str.
+# Fall back to the stdlib if unavailable. orjson.JSONDecodeError subclasses
+# json.JSONDecodeError, so the handlers below catch either.
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _json_loads(data):
+        # json.loads() takes bytes but not a memoryview
+        return json.loads(bytes(data))
+
+logger = logging.getLogger(__name__)
+
 # Protocol definitions (HyperTCP)
 HYPER_TCP_CMD_RESPONSE      = 0
 HYPER_TCP_CMD_PING          = 6
@@ -24,318 +50,411 @@ HYPER_TCP_STATUS_INVALID_TOKEN     = 9
 HYPER_TCP_STATUS_NOT_AUTHENTICATED = 5
 HYPER_TCP_STATUS_TIMEOUT           = 16
 
-class HyperTCPHeader:
-    def __init__(self, type=0, msg_id=0, length=0):
-        self.type = type
-        self.msg_id = msg_id
-        self.length = length
-    
-    def pack(self):
-        return struct.pack('!BHH', self.type, self.msg_id, self.length)
+# Header layout: type (1 byte), message id (2 bytes), payload length (2 bytes)
+_HDR = struct.Struct('!BHH')
+_pack_header = _HDR.pack
+_unpack_header_from = _HDR.unpack_from
+
+# RESPONSE frames with a status are packed in one call as
+# (type, msg_id, length, status byte)
+_RESP_STATUS_PACKER = struct.Struct('!BHHB').pack
+
+# Login credentials (test server): device IDs with the admin prefix, or the
+# admin token, mark an admin client; each role accepts only its own token
+ADMIN_TOKEN = "admin_token"
+DEVICE_TOKEN = "your_auth_token_here"
+ADMIN_DEVICE_PREFIX = "admin_"
+
+# Local clients (admin dashboards, sidecars) can skip the loopback TCP/IP
+# stack through a Unix domain socket; pass this (or another path) as
+# unix_path, or set the environment variable when running the script
+UNIX_SOCKET_PATH = '/tmp/hypertcp.sock'
+UNIX_SOCKET_ENV = 'HYPERTCP_UNIX_SOCKET'
+
+# Kernel send/receive buffer size for client connections, set on the listening
+# socket so accepted connections inherit it (and the SYN-ACK window scale)
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# Most output a fan-out recipient may leave unsent in its transport before
+# it is dropped
+MAX_WRITE_BUFFER_SIZE = 4 << 20
+
+# Pre-encoded welcome message; only clientId and timestamp vary per client
+_WELCOME_PREFIX = b'{"type":"welcome","message":"Connected to HyperTCP server","clientId":'
+_WELCOME_MID = b',"timestamp":'
+_WELCOME_SUFFIX = b'}'
+
+# Insignificant whitespace around JSON tokens
+_JSON_WHITESPACE = b' \t\r\n'
+
+class ClientState:
+    """Per-connection record kept in HyperTCPProtocolServer.clients"""
+    __slots__ = ('client_id', 'transport', 'address', 'authenticated', 'device_id', 'connect_time', 'is_admin')
     
-    @classmethod
-    def unpack(cls, data):
-        type, msg_id, length = struct.unpack('!BHH', data)
-        return cls(type, msg_id, length)
+    def __init__(self, client_id, transport, address):
+        self.client_id = client_id
+        self.transport = transport
+        self.address = address
+        self.authenticated = False
+        self.device_id = None  # Will be set during authentication
+        self.connect_time = time.monotonic_ns()  # Track connection time
+        self.is_admin = False  # Track if this is an admin client
+
+HEADER_SIZE = _HDR.size
+MAX_FRAME_SIZE = HEADER_SIZE + 0xFFFF
+# Receive buffer a connection starts with; it grows (up to MAX_FRAME_SIZE)
+# only when a pending header announces a frame that does not fit
+INITIAL_RECV_BUFFER_SIZE = 8 * 1024
+
+class HyperTCPConnection(asyncio.BufferedProtocol):
+    """A client connection that parses frames in place from a reusable buffer
+
+    The transport reads straight into the connection's bytearray, so one
+    recv usually delivers the header and payload (often several frames)
+    and no per-read bytes object is allocated.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.client_id = None
+        self.client = None  # This connection's ClientState, bound once
+        self._buffer = bytearray(INITIAL_RECV_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First byte not yet parsed
+        self._end = 0    # End of the received data
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client = self.server.register_client(transport)
+        self.client_id = self.client.client_id
+
+    def get_buffer(self, sizehint):
+        start, end = self._start, self._end
+        pending = end - start
+        # Bytes the next frame needs: its header, then the whole frame
+        needed = HEADER_SIZE
+        if pending >= HEADER_SIZE:
+            needed += _unpack_header_from(self._view, start)[2]
+        
+        if needed > len(self._buffer):
+            # Frame larger than the buffer: move to a bigger one
+            buffer = bytearray(min(max(needed, 2 * len(self._buffer)), MAX_FRAME_SIZE))
+            buffer[:pending] = self._view[start:end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self._start, self._end = 0, pending
+        elif len(self._buffer) - end < needed - pending:
+            # Move the partial frame to the front so the rest of it fits
+            self._view[:pending] = bytes(self._view[start:end])
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        view = self._view
+        start = self._start
+        end = self._end = self._end + nbytes
+
+        try:
+            # Dispatch every complete frame without another read
+            while end - start >= HEADER_SIZE:
+                msg_type, msg_id, length = _unpack_header_from(view, start)
+                frame_end = start + HEADER_SIZE + length
+                if frame_end > end:
+                    break
+                # A view into the receive buffer, not a copy; it is only valid
+                # until handle_message() returns
+                payload = view[start + HEADER_SIZE:frame_end]
+                start = frame_end
+                if not self.server.handle_message(self.client, msg_type, msg_id, payload):
+                    self.transport.close()
+                    break
+        except Exception as e:
+            logger.error("Error handling client %s: %s", self.client_id, e)
+            self.transport.close()
+
+        if start == end:
+            # Everything consumed; start over at the front of the buffer
+            start = self._end = 0
+        self._start = start
+
+    def pause_writing(self):
+        # Stop reading from a client that is not reading its own replies
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        # Clean up the client connection
+        self.server.cleanup_client_connection(self.client_id, self.transport)
 
 class HyperTCPProtocolServer:
-    def __init__(self, host='0.0.0.0', port=8080):
+    def __init__(self, host='0.0.0.0', port=8080, unix_path=None):
         self.host = host
         self.port = port
-        self.server_socket = None
+        self.unix_path = unix_path if hasattr(socket, 'AF_UNIX') else None  # None: TCP only
+        self.server = None
+        self.unix_server = None
+        self._unix_inode = None  # (st_dev, st_ino) of the socket file we created
         self.clients = {}  # Store individual client connections
-        self.device_connections = defaultdict(list)  # Group connections by device ID
+        self.device_connections = defaultdict(set)  # Group connections by device ID
         self.admin_clients = set()  # Separate set for admin clients
         self.running = False
         self.device_id = "server"
         self.client_counter = 0
         
-    def start(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+    async def start(self):
+        # Each accepted connection gets its own HyperTCPConnection
+        loop = asyncio.get_running_loop()
+        if self.unix_path:
+            await self._check_unix_path_free()
+        self.server = await loop.create_server(
+            lambda: HyperTCPConnection(self), self.host, self.port, backlog=1024
+        )
+        # Larger buffers absorb broadcast bursts without pausing the writer
+        for listener in self.server.sockets:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        if self.unix_path:
+            # Same protocol and handlers; only the socket family differs
+            self.unix_server = await loop.create_unix_server(
+                lambda: HyperTCPConnection(self), self.unix_path, backlog=1024
+            )
+            st = os.stat(self.unix_path)
+            self._unix_inode = (st.st_dev, st.st_ino)
         self.running = True
         
-        print(f"HyperTCP Server listening on {self.host}:{self.port}")
+        logger.info("HyperTCP Server listening on %s:%s", self.host, self.port)
+        if self.unix_server:
+            logger.info("HyperTCP Server listening on unix socket %s", self.unix_path)
         
-        while self.running:
-            try:
-                client_socket, address = self.server_socket.accept()
-                print(f"Client connected from {address}")
-                
-                # Handle client in a separate thread
-                client_thread = threading.Thread(
-                    target=self.handle_client, 
-                    args=(client_socket, address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-            except Exception as e:
-                if self.running:
-                    print(f"Error accepting connections: {e}")
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.stop()
+    
+    async def _check_unix_path_free(self):
+        """Refuse to start if another server is still accepting on our Unix socket path"""
+        # create_unix_server() replaces any socket file at the path, live or not
+        try:
+            _, writer = await asyncio.open_unix_connection(self.unix_path)
+        except OSError:
+            return  # Nothing there, or a stale socket nobody accepts on
+        writer.close()
+        raise OSError(errno.EADDRINUSE, f"Unix socket {self.unix_path} is already in use")
     
     def stop(self):
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
+        if self.server:
+            self.server.close()
+        if self.unix_server:
+            self.unix_server.close()
+            self.unix_server = None
+            # Only remove the socket file if it is still ours; another server
+            # may have bound the same path since
+            try:
+                st = os.stat(self.unix_path)
+                if (st.st_dev, st.st_ino) == self._unix_inode:
+                    os.unlink(self.unix_path)
+            except OSError:
+                pass
+            self._unix_inode = None
             
         # Close all client connections
         for client_id in list(self.clients.keys()):
             try:
-                self.clients[client_id]['socket'].close()
+                self.clients[client_id].transport.close()
             except:
                 pass
         self.clients.clear()
         self.device_connections.clear()
         self.admin_clients.clear()
-        print("Server stopped and all connections cleaned up")
+        logger.info("Server stopped and all connections cleaned up")
     
-    def handle_client(self, client_socket, address):
-        temp_client_id = None
-        try:
-            authenticated = False
-            # Generate a temporary client ID until authentication
-            temp_client_id = f"client_{address[0]}_{address[1]}_{self.client_counter}"
-            self.client_counter += 1
+    def register_client(self, transport):
+        """Register a new connection under a temporary ID and return its ClientState"""
+        # asyncio enables TCP_NODELAY on stream transports, so each
+        # frame's single write goes out immediately
+        address = transport.get_extra_info('peername')
+        if isinstance(address, tuple):
+            logger.info("Client connected from %s", address)
+            client_tag = f"{address[0]}_{address[1]}"
+        else:
+            # Unix domain socket peers are usually unnamed
+            address = self.unix_path
+            logger.info("Client connected on unix socket %s", address)
+            client_tag = "unix"
+        
+        # Generate a temporary client ID until authentication
+        temp_client_id = f"client_{client_tag}_{self.client_counter}"
+        self.client_counter += 1
+        
+        # Register client with temporary ID
+        client = self.clients[temp_client_id] = ClientState(temp_client_id, transport, address)
+        
+        logger.info("Client registered as %s", temp_client_id)
+        return client
+    
+    def handle_message(self, client, msg_type, msg_id, payload):
+        """Handle one complete frame; returns False if the connection should close"""
+        # client is the ClientState the connection bound in connection_made()
+        temp_client_id = client.client_id
+        transport = client.transport
+        logger.debug("Received message: type=%d, id=%d, length=%d", msg_type, msg_id, len(payload))
+        
+        # Handle different message types
+        if msg_type == HYPER_TCP_CMD_LOGIN:
+            # Handle login with device ID
+            device_id, is_admin, authenticated = self._authenticate(temp_client_id, payload)
+            status = HYPER_TCP_STATUS_SUCCESS if authenticated else HYPER_TCP_STATUS_INVALID_TOKEN
             
-            # Register client with temporary ID
-            self.clients[temp_client_id] = {
-                'socket': client_socket,
-                'address': address,
-                'authenticated': False,
-                'device_id': None,  # Will be set during authentication
-                'connect_time': time.time(),  # Track connection time
-                'is_admin': False  # Track if this is an admin client
-            }
+            # Update client authentication status
+            client.authenticated = authenticated
+            client.is_admin = is_admin
             
-            print(f"Client registered as {temp_client_id}")
+            # Send response first: embedded clients expect it as the first
+            # frame after LOGIN
+            self.send_response(transport, msg_id, status)
             
-            while True:
-                # Read header (5 bytes)
-                header_data = self.recv_all(client_socket, 5)
-                if not header_data or len(header_data) < 5:
-                    break
+            if not authenticated:
+                logger.warning("Client %s failed authentication", temp_client_id)
+                return False
+            
+            # Set the device_id
+            client.device_id = device_id
+            
+            if is_admin:
+                # Register as admin client
+                self.admin_clients.add(temp_client_id)
+                logger.info("Admin client %s authenticated with device ID %s", temp_client_id, device_id)
+                # Send welcome message
+                self.send_welcome_message(transport, temp_client_id)
                 
-                header = HyperTCPHeader.unpack(header_data)
-                print(f"Received message: type={header.type}, id={header.msg_id}, length={header.length}")
+                # Send initial connection status for all currently connected devices
+                self.send_initial_connection_status(temp_client_id)
+            else:
+                # Register as regular device client
+                # Add this connection to the device's connection list
+                self.device_connections[device_id].add(temp_client_id)
                 
-                # Read payload if any
-                payload = b''
-                if header.length > 0:
-                    payload = self.recv_all(client_socket, header.length)
-                    if not payload:
-                        break
+                logger.info("Client %s authenticated with device ID %s", temp_client_id, device_id)
+                logger.info("Device %s now has %d connections", device_id, len(self.device_connections[device_id]))
+                # Send welcome message
+                self.send_welcome_message(transport, temp_client_id)
                 
-                # Handle different message types
-                if header.type == HYPER_TCP_CMD_LOGIN:
-                    # Handle login with device ID
-                    try:
-                        # Payload should be JSON with token and device_id
-                        login_data = json.loads(payload.decode('utf-8'))
-                        token = login_data.get("token", "")
-                        device_id = login_data.get("device_id", temp_client_id)
-                        
-                        print(f"Login attempt - Token: {token}, Device ID: {device_id}")
-                        
-                        # Check if this is an admin client
-                        is_admin = device_id.startswith("admin_") or token == "admin_token"
-                        
-                        # Simple authentication
-                        if is_admin:
-                            authenticated = (token == "admin_token")
-                            status = HYPER_TCP_STATUS_SUCCESS if authenticated else HYPER_TCP_STATUS_INVALID_TOKEN
-                        else:
-                            authenticated = (token == "your_auth_token_here")
-                            status = HYPER_TCP_STATUS_SUCCESS if authenticated else HYPER_TCP_STATUS_INVALID_TOKEN
-                        
-                        # Update client authentication status
-                        self.clients[temp_client_id]['authenticated'] = authenticated
-                        self.clients[temp_client_id]['is_admin'] = is_admin
-                        
-                        # If authenticated, register appropriately
-                        if authenticated:
-                            # Set the device_id
-                            self.clients[temp_client_id]['device_id'] = device_id
-                            
-                            if is_admin:
-                                # Register as admin client
-                                self.admin_clients.add(temp_client_id)
-                                print(f"Admin client {temp_client_id} authenticated with device ID {device_id}")
-                                # Send welcome message
-                                self.send_welcome_message(client_socket, temp_client_id)
-                                
-                                # Send initial connection status for all currently connected devices
-                                self.send_initial_connection_status(temp_client_id)
-                            else:
-                                # Register as regular device client
-                                # Add this connection to the device's connection list
-                                self.device_connections[device_id].append(temp_client_id)
-                                
-                                print(f"Client {temp_client_id} authenticated with device ID {device_id}")
-                                print(f"Device {device_id} now has {len(self.device_connections[device_id])} connections")
-                                # Send welcome message
-                                self.send_welcome_message(client_socket, temp_client_id)
-                                
-                                # Notify admin channels about new connection (if any exist)
-                                self.notify_admin_channels({
-                                    "event": "deviceConnected",
-                                    "deviceId": device_id,
-                                    "clientId": temp_client_id,
-                                    "timestamp": int(time.time() * 1000)
-                                })
-                        else:
-                            print(f"Client {temp_client_id} failed authentication")
-                        
-                        # Send response
-                        response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 1)
-                        client_socket.send(response_header.pack())
-                        client_socket.send(struct.pack('!B', status))
-                        
-                        if not authenticated:
-                            break
-                        
-                    except json.JSONDecodeError:
-                        # Fallback to old method for backward compatibility
-                        token = payload.decode('utf-8')
-                        device_id = temp_client_id
-                        is_admin = token == "admin_token"
-                        
-                        print(f"Login attempt with token: {token}")
-                        
-                        # Simple authentication
-                        if is_admin:
-                            authenticated = (token == "admin_token")
-                            status = HYPER_TCP_STATUS_SUCCESS if authenticated else HYPER_TCP_STATUS_INVALID_TOKEN
-                        else:
-                            authenticated = (token == "your_auth_token_here")
-                            status = HYPER_TCP_STATUS_SUCCESS if authenticated else HYPER_TCP_STATUS_INVALID_TOKEN
-                        
-                        # Update client authentication status
-                        self.clients[temp_client_id]['authenticated'] = authenticated
-                        self.clients[temp_client_id]['is_admin'] = is_admin
-                        self.clients[temp_client_id]['device_id'] = device_id
-                        
-                        # Send response
-                        response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 1)
-                        client_socket.send(response_header.pack())
-                        client_socket.send(struct.pack('!B', status))
-                        
-                        if authenticated:
-                            if is_admin:
-                                # Register as admin client
-                                self.admin_clients.add(temp_client_id)
-                                print(f"Admin client {temp_client_id} authenticated")
-                                # Send welcome message
-                                self.send_welcome_message(client_socket, temp_client_id)
-                                
-                                # Send initial connection status for all currently connected devices
-                                self.send_initial_connection_status(temp_client_id)
-                            else:
-                                # Register as regular device client
-                                # Add this connection to the device's connection list
-                                self.device_connections[device_id].append(temp_client_id)
-                                
-                                print(f"Client {temp_client_id} authenticated")
-                                print(f"Device {device_id} now has {len(self.device_connections[device_id])} connections")
-                                # Send welcome message
-                                self.send_welcome_message(client_socket, temp_client_id)
-                                
-                                # Notify admin channels about new connection (if any exist)
-                                self.notify_admin_channels({
-                                    "event": "deviceConnected",
-                                    "deviceId": device_id,
-                                    "clientId": temp_client_id,
-                                    "timestamp": int(time.time() * 1000)
-                                })
-                        else:
-                            print(f"Client {temp_client_id} failed authentication")
-                            break
-                        
-                elif header.type == HYPER_TCP_CMD_PING:
-                    # Send pong response
-                    response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 0)
-                    client_socket.send(response_header.pack())
-                    print("Ping-Pong")
+                # Notify admin channels about new connection (if any exist)
+                self.notify_admin_channels({
+                    "event": "deviceConnected",
+                    "deviceId": device_id,
+                    "clientId": temp_client_id
+                })
+                
+        elif msg_type == HYPER_TCP_CMD_PING:
+            # Send pong response
+            self.send_response(transport, msg_id)
+            logger.debug("Ping-Pong")
+            
+        elif msg_type == HYPER_TCP_CMD_JSON_MESSAGE:
+            if client.authenticated:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("JSON message received: %s", str(payload, 'utf-8', 'replace'))
+                
+                try:
+                    # Parse the JSON message
+                    message = _json_loads(payload)
                     
-                elif header.type == HYPER_TCP_CMD_JSON_MESSAGE:
-                    if self.clients[temp_client_id]['authenticated']:
-                        json_data = payload.decode('utf-8')
-                        print(f"JSON message received: {json_data}")
-                        
-                        try:
-                            # Parse the JSON message
-                            message = json.loads(json_data)
-                            
-                            # Extract target and payload
-                            target_id = message.get("targetId")
-                            message_payload = message.get("payload", {})
-                            
-                            print(f"Target: {target_id}")
-                            print(f"Payload: {message_payload}")
-                            
-                            # Add sender info (use device_id if available)
-                            sender_id = self.clients[temp_client_id].get('device_id', temp_client_id)
-                            message["from"] = sender_id
-                            
-                            # Route message based on target
-                            self.route_message(sender_id, target_id, message)
-                            
-                            # If it's a ping command, respond
-                            if message_payload.get("command") == "ping":
-                                self.send_pong_response(client_socket, message_payload)
-                            
-                            # Send acknowledgment
-                            response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 0)
-                            client_socket.send(response_header.pack())
-                            
-                        except json.JSONDecodeError as e:
-                            print(f"JSON decode error: {e}")
-                    else:
-                        break
-                        
-                elif header.type == HYPER_TCP_CMD_BROADCAST:
-                    if self.clients[temp_client_id]['authenticated']:
-                        json_data = payload.decode('utf-8')
-                        print(f"Broadcast message received: {json_data}")
-                        
-                        try:
-                            # Parse the JSON message
-                            message = json.loads(json_data)
-                            
-                            # Add sender info (use device_id if available)
-                            sender_id = self.clients[temp_client_id].get('device_id', temp_client_id)
-                            message["from"] = sender_id
-                            
-                            # Broadcast to all clients
-                            self.broadcast_message(message)
-                            
-                            # Send acknowledgment
-                            response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 0)
-                            client_socket.send(response_header.pack())
-                            
-                        except json.JSONDecodeError as e:
-                            print(f"JSON decode error: {e}")
-                    else:
-                        break
-                        
-                elif header.type == HYPER_TCP_CMD_RESPONSE:
-                    # Just acknowledge responses
-                    pass
+                    # Extract target and payload
+                    target_id = message.get("targetId")
+                    message_payload = message.get("payload", {})
                     
-                else:
-                    print(f"Unknown command type: {header.type}")
-                    # Send error response
-                    response_header = HyperTCPHeader(HYPER_TCP_CMD_RESPONSE, header.msg_id, 1)
-                    client_socket.send(response_header.pack())
-                    client_socket.send(struct.pack('!B', 2))  # Invalid command
+                    logger.debug("Target: %s", target_id)
+                    logger.debug("Payload: %s", message_payload)
                     
-        except Exception as e:
-            print(f"Error handling client {temp_client_id}: {e}")
-        finally:
-            # Clean up the client connection
-            self.cleanup_client_connection(temp_client_id, client_socket)
+                    # Add sender info (use device_id if available)
+                    sender_id = client.device_id
+                    # Fan-out relays the client's own bytes with "from" added,
+                    # unless the client sent a "from" that must be overwritten
+                    raw_payload = None if "from" in message else payload
+                    message["from"] = sender_id
+                    
+                    # Route message based on target
+                    self.route_message(sender_id, target_id, message, raw_payload)
+                    
+                    # If it's a ping command, respond
+                    if message_payload.get("command") == "ping":
+                        self.send_pong_response(transport, message_payload)
+                    
+                    # Send acknowledgment
+                    self.send_response(transport, msg_id)
+                    
+                except json.JSONDecodeError as e:
+                    logger.warning("JSON decode error: %s", e)
+            else:
+                return False
+                
+        elif msg_type == HYPER_TCP_CMD_BROADCAST:
+            if client.authenticated:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Broadcast message received: %s", str(payload, 'utf-8', 'replace'))
+                
+                try:
+                    # Parse the JSON message
+                    message = _json_loads(payload)
+                    
+                    # Add sender info (use device_id if available)
+                    sender_id = client.device_id
+                    raw_payload = None if "from" in message else payload
+                    message["from"] = sender_id
+                    
+                    # Broadcast to all clients
+                    self.broadcast_message(message, raw_payload)
+                    
+                    # Send acknowledgment
+                    self.send_response(transport, msg_id)
+                    
+                except json.JSONDecodeError as e:
+                    logger.warning("JSON decode error: %s", e)
+            else:
+                return False
+                
+        elif msg_type == HYPER_TCP_CMD_RESPONSE:
+            # Just acknowledge responses
+            pass
+            
+        else:
+            logger.warning("Unknown command type: %d", msg_type)
+            # Send error response
+            self.send_response(transport, msg_id, 2)  # Invalid command
+        
+        return True
+    
+    def _authenticate(self, client_id, payload):
+        """Check a LOGIN payload; returns (device_id, is_admin, authenticated)
+        
+        The payload is JSON with token and device_id. A bare token is still
+        accepted for backward compatibility and keeps the temporary client ID.
+        """
+        try:
+            login_data = _json_loads(payload)
+            token = login_data.get("token", "")
+            device_id = login_data.get("device_id", client_id)
+            logger.info("Login attempt - Token: %s, Device ID: %s", token, device_id)
+            
+            # Check if this is an admin client
+            is_admin = device_id.startswith(ADMIN_DEVICE_PREFIX) or token == ADMIN_TOKEN
+        except json.JSONDecodeError:
+            # Fallback to old method for backward compatibility
+            token = str(payload, 'utf-8')
+            device_id = client_id
+            logger.info("Login attempt with token: %s", token)
+            
+            is_admin = token == ADMIN_TOKEN
+        
+        # Simple authentication: each role has a single valid token
+        authenticated = token == (ADMIN_TOKEN if is_admin else DEVICE_TOKEN)
+        return device_id, is_admin, authenticated
     
     def send_initial_connection_status(self, admin_client_id):
         """Send initial connection status to a newly connected admin client"""
@@ -343,12 +462,18 @@ class HyperTCPProtocolServer:
             return
             
         try:
-            # Send information about all currently connected devices
+            # One clock reading for the whole batch of status events
+            now = time.monotonic_ns()
+            timestamp = time.time_ns() // 1_000_000
+            
+            # Frame one event per connected device and queue the batch with
+            # a single writelines() call
+            frames = []
             for device_id, connections in self.device_connections.items():
                 for client_id in connections:
-                    if client_id in self.clients:
-                        connect_time = self.clients[client_id].get('connect_time', time.time())
-                        uptime = time.time() - connect_time
+                    client = self.clients.get(client_id)
+                    if client is not None:
+                        uptime = (now - client.connect_time) / 1e9
                         
                         event_data = {
                             "event": "deviceStatus",
@@ -356,201 +481,286 @@ class HyperTCPProtocolServer:
                             "clientId": client_id,
                             "status": "connected",
                             "uptime": uptime,
-                            "timestamp": int(time.time() * 1000)
+                            "timestamp": timestamp
                         }
                         
-                        self.send_to_admin_client(admin_client_id, event_data)
+                        frame = self.encode_message_frame(event_data)
+                        if frame is not None:
+                            frames.append(frame)
+            
+            if frames:
+                self.send_to_admin_client(admin_client_id, frames)
         except Exception as e:
-            print(f"Error sending initial connection status to admin {admin_client_id}: {e}")
+            logger.error("Error sending initial connection status to admin %s: %s", admin_client_id, e)
     
-    def send_to_admin_client(self, admin_client_id, event_data):
-        """Send event data to a specific admin client"""
-        if admin_client_id in self.clients and self.clients[admin_client_id]['authenticated']:
+    def send_to_admin_client(self, admin_client_id, frames):
+        """Send already-encoded event frames to a specific admin client"""
+        if admin_client_id in self.clients and self.clients[admin_client_id].authenticated:
+            transport = self.clients[admin_client_id].transport
+            if self._drop_if_backlogged(admin_client_id, transport):
+                return
             try:
-                json_data = json.dumps(event_data)
-                payload_bytes = json_data.encode('utf-8')
-                
-                header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes))
-                self.clients[admin_client_id]['socket'].send(header.pack())
-                self.clients[admin_client_id]['socket'].send(payload_bytes)
-                print(f"Sent admin event to {admin_client_id}: {event_data}")
+                transport.writelines(frames)
+                logger.debug("Sent %d admin event(s) to %s", len(frames), admin_client_id)
             except Exception as e:
-                print(f"Error sending to admin client {admin_client_id}: {e}")
-                # If there's an error sending to admin client, clean up that connection
-                self.cleanup_client_connection(admin_client_id, self.clients[admin_client_id]['socket'])
+                logger.error("Error sending to admin client %s: %s", admin_client_id, e)
+                # Drop the connection; connection_lost() cleans it up on the next
+                # loop pass, so fan-out loops never see their container change
+                transport.abort()
     
-    def cleanup_client_connection(self, client_id, client_socket):
+    def cleanup_client_connection(self, client_id, transport):
         """Clean up a client connection and update device groups"""
         if client_id and client_id in self.clients:
-            device_id = self.clients[client_id].get('device_id')
-            connect_time = self.clients[client_id].get('connect_time', time.time())
-            connection_duration = time.time() - connect_time
-            is_admin = self.clients[client_id].get('is_admin', False)
-            
             # Remove client from registry
-            del self.clients[client_id]
+            client = self.clients.pop(client_id)
+            device_id = client.device_id
+            connection_duration = (time.monotonic_ns() - client.connect_time) / 1e9
+            is_admin = client.is_admin
             
             if is_admin:
                 # Remove from admin clients set
                 self.admin_clients.discard(client_id)
-                print(f"Admin client {client_id} disconnected after {connection_duration:.2f} seconds")
+                logger.info("Admin client %s disconnected after %.2f seconds", client_id, connection_duration)
             else:
                 # Remove from device connections group
                 if device_id and device_id in self.device_connections:
                     if client_id in self.device_connections[device_id]:
                         self.device_connections[device_id].remove(client_id)
-                        print(f"Removed connection {client_id} from device {device_id}")
+                        logger.info("Removed connection %s from device %s", client_id, device_id)
                         
                         # Check if device group is now empty
                         if not self.device_connections[device_id]:
                             del self.device_connections[device_id]
-                            print(f"Device group {device_id} is now empty and has been removed")
+                            logger.info("Device group %s is now empty and has been removed", device_id)
                         
                         # Notify admin channels about disconnection
                         self.notify_admin_channels({
                             "event": "deviceDisconnected",
                             "deviceId": device_id,
                             "clientId": client_id,
-                            "connectionDuration": connection_duration,
-                            "timestamp": int(time.time() * 1000)
+                            "connectionDuration": connection_duration
                         })
                 
-                print(f"Client {client_id} disconnected after {connection_duration:.2f} seconds")
+                logger.info("Client %s disconnected after %.2f seconds", client_id, connection_duration)
         else:
-            print("Client disconnected (no client ID assigned)")
+            logger.info("Client disconnected (no client ID assigned)")
             
-        # Always close the socket
-        if client_socket:
+        # Always close the connection
+        if transport:
             try:
-                client_socket.close()
+                transport.close()
             except:
                 pass
     
     def notify_admin_channels(self, event_data):
         """Notify all admin channels about connection events"""
+        # Stamp and serialize the event once for every admin it goes to
+        event_data["timestamp"] = time.time_ns() // 1_000_000
+        frame = self.encode_message_frame(event_data)
+        if frame is None:
+            return
+        frames = (frame,)
+        
         # Send events to all admin clients
-        admin_clients_copy = self.admin_clients.copy()
-        for admin_client_id in admin_clients_copy:
-            self.send_to_admin_client(admin_client_id, event_data)
+        # Failed sends only abort the transport; connection_lost() removes the
+        # client on a later loop pass, so the set is unchanged during the loop
+        for admin_client_id in self.admin_clients:
+            self.send_to_admin_client(admin_client_id, frames)
     
-    def route_message(self, sender_id, target_id, message):
-        """Route message to appropriate target"""
-        print(f"Routing message from {sender_id} to {target_id}")
+    def route_message(self, sender_id, target_id, message, raw_payload=None):
+        """Route message to appropriate target (raw_payload: the sender's JSON, to relay as-is)"""
+        logger.debug("Routing message from %s to %s", sender_id, target_id)
         
         if target_id == "broadcast":
             # Broadcast to all clients
-            self.broadcast_message(message)
+            self.broadcast_message(message, raw_payload)
         elif target_id == "server":
             # Message to server - handle internally
             self.handle_server_message(sender_id, message)
         elif target_id in self.device_connections:
             # Message to specific device - send to all connections for that device
-            self.send_to_device(target_id, message)
+            self.send_to_device(target_id, message, raw_payload)
         else:
-            print(f"Target device {target_id} not found")
+            logger.warning("Target device %s not found", target_id)
     
-    def broadcast_message(self, message):
+    def broadcast_message(self, message, raw_payload=None):
         """Broadcast message to all connected clients"""
-        print("Broadcasting message to all clients")
+        logger.debug("Broadcasting message to all clients")
+        
+        # Serialize and frame once, then write the same bytes to every client
+        frame = self.encode_message_frame(message, raw_payload)
+        if frame is None:
+            return
         
         # Send to all clients
-        clients_copy = list(self.clients.items())
-        for client_id, client_info in clients_copy:
-            if client_info['authenticated']:  # Only send to authenticated clients
+        for client_id, client_info in self.clients.items():
+            if client_info.authenticated:  # Only send to authenticated clients
+                if self._drop_if_backlogged(client_id, client_info.transport):
+                    continue
                 try:
-                    json_data = json.dumps(message)
-                    payload_bytes = json_data.encode('utf-8')
-                    
-                    header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes))
-                    client_info['socket'].send(header.pack())
-                    client_info['socket'].send(payload_bytes)
+                    client_info.transport.write(frame)
                 except Exception as e:
-                    print(f"Error sending to client {client_id}: {e}")
-                    # If there's an error sending to client, clean up that connection
-                    self.cleanup_client_connection(client_id, client_info['socket'])
+                    logger.error("Error sending to client %s: %s", client_id, e)
+                    # If there's an error sending to client, drop that connection
+                    client_info.transport.abort()
     
-    def send_to_device(self, device_id, message):
+    def send_to_device(self, device_id, message, raw_payload=None):
         """Send message to all connections of a specific device"""
-        print(f"Sending message to device {device_id}")
+        logger.debug("Sending message to device %s", device_id)
         
         if device_id in self.device_connections:
+            # Serialize and frame once for all of the device's connections
+            frame = self.encode_message_frame(message, raw_payload)
+            if frame is None:
+                return
+            
             # Send to all connections for this device
-            connections_copy = self.device_connections[device_id][:]  # Create a copy
-            for client_id in connections_copy:
-                if client_id in self.clients and self.clients[client_id]['authenticated']:
+            for client_id in self.device_connections[device_id]:
+                if client_id in self.clients and self.clients[client_id].authenticated:
+                    transport = self.clients[client_id].transport
+                    if self._drop_if_backlogged(client_id, transport):
+                        continue
                     try:
-                        json_data = json.dumps(message)
-                        payload_bytes = json_data.encode('utf-8')
-                        
-                        header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes))
-                        self.clients[client_id]['socket'].send(header.pack())
-                        self.clients[client_id]['socket'].send(payload_bytes)
+                        transport.write(frame)
                     except Exception as e:
-                        print(f"Error sending to client {client_id}: {e}")
-                        # If there's an error sending to client, clean up that connection
-                        self.cleanup_client_connection(client_id, self.clients[client_id]['socket'])
+                        logger.error("Error sending to client %s: %s", client_id, e)
+                        # If there's an error sending to client, drop that connection
+                        transport.abort()
+    
+    def _drop_if_backlogged(self, client_id, transport):
+        """Abort a fan-out recipient that is not keeping up; returns True if it was dropped
+        
+        pause_writing() only stops reading from the slow recipient itself,
+        while other clients keep queueing frames for it.
+        """
+        if transport.is_closing():
+            return True
+        if transport.get_write_buffer_size() > MAX_WRITE_BUFFER_SIZE:
+            logger.warning("Dropping client %s: %d bytes of output unsent",
+                           client_id, transport.get_write_buffer_size())
+            transport.abort()
+            return True
+        return False
+    
+    def encode_message_frame(self, message, raw_payload=None):
+        """Build a complete JSON_MESSAGE frame for fan-out, or None if it can't be framed
+        
+        With raw_payload, the sender's JSON is relayed with "from" added
+        instead of serializing the parsed message again.
+        """
+        payload_bytes = None
+        if raw_payload is not None:
+            payload_bytes = self.relay_payload(raw_payload, message["from"])
+        if payload_bytes is None:
+            payload_bytes = _json_dumps(message)
+        try:
+            return _pack_header(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes)) + payload_bytes
+        except struct.error:
+            logger.error("Message of %d bytes is too large to frame", len(payload_bytes))
+            return None
+    
+    def relay_payload(self, payload, sender_id):
+        """Add the sender to a client's raw JSON object without re-encoding it
+        
+        Returns None when the bytes are not a JSON object, so callers fall
+        back to serializing the parsed message. The result is a copy, so it
+        stays valid after the receive buffer is reused.
+        """
+        # Find the closing brace without copying the payload
+        end = len(payload)
+        while end and payload[end - 1] in _JSON_WHITESPACE:
+            end -= 1
+        if not end or payload[end - 1] != 0x7D:  # '}'
+            return None
+        end -= 1
+        while end and payload[end - 1] in _JSON_WHITESPACE:
+            end -= 1
+        separator = b'' if end and payload[end - 1] == 0x7B else b','  # '{'
+        return b''.join((payload[:end], separator, b'"from":', _json_dumps(sender_id), b'}'))
     
     def handle_server_message(self, sender_id, message):
         """Handle messages sent directly to the server"""
-        print(f"Server received message from {sender_id}: {message}")
+        logger.info("Server received message from %s: %s", sender_id, message)
         # For now, just acknowledge
         # In a real implementation, you might want to process specific commands here
     
-    def send_welcome_message(self, client_socket, client_id):
+    def send_welcome_message(self, transport, client_id):
         """Send welcome message to newly connected client"""
         try:
-            welcome_data = {
-                "type": "welcome",
-                "message": "Connected to HyperTCP server",
-                "clientId": client_id,
-                "timestamp": int(time.time() * 1000)
-            }
+            # Splice the two varying fields into the pre-encoded template
+            payload_bytes = b''.join((
+                _WELCOME_PREFIX,
+                _json_dumps(client_id),
+                _WELCOME_MID,
+                str(time.time_ns() // 1_000_000).encode('ascii'),
+                _WELCOME_SUFFIX
+            ))
             
-            json_data = json.dumps(welcome_data)
-            payload_bytes = json_data.encode('utf-8')
-            
-            header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes))
-            client_socket.send(header.pack())
-            client_socket.send(payload_bytes)
-            print(f"Sent welcome message to {client_id}")
+            self.send_frame(transport, HYPER_TCP_CMD_JSON_MESSAGE, 0, payload_bytes)
+            logger.debug("Sent welcome message to %s", client_id)
         except Exception as e:
-            print(f"Error sending welcome message to {client_id}: {e}")
+            logger.error("Error sending welcome message to %s: %s", client_id, e)
     
-    def send_pong_response(self, client_socket, ping_payload):
+    def send_pong_response(self, transport, ping_payload):
         """Send pong response to ping command"""
         try:
             pong_data = {
                 "type": "pong",
                 "command": "pong",
-                "timestamp": int(time.time() * 1000)
+                "timestamp": time.time_ns() // 1_000_000
             }
             
             # Merge with original ping payload if needed
             pong_data.update(ping_payload)
             
-            json_data = json.dumps(pong_data)
-            payload_bytes = json_data.encode('utf-8')
+            payload_bytes = _json_dumps(pong_data)
             
-            header = HyperTCPHeader(HYPER_TCP_CMD_JSON_MESSAGE, 0, len(payload_bytes))
-            client_socket.send(header.pack())
-            client_socket.send(payload_bytes)
+            self.send_frame(transport, HYPER_TCP_CMD_JSON_MESSAGE, 0, payload_bytes)
         except Exception as e:
-            print(f"Error sending pong response: {e}")
+            logger.error("Error sending pong response: %s", e)
+    
+    def send_response(self, transport, msg_id, status=None):
+        """Send a RESPONSE frame, optionally carrying a one-byte status"""
+        if status is None:
+            transport.write(_pack_header(HYPER_TCP_CMD_RESPONSE, msg_id, 0))
+        else:
+            transport.write(_RESP_STATUS_PACKER(HYPER_TCP_CMD_RESPONSE, msg_id, 1, status))
+    
+    def send_frame(self, transport, msg_type, msg_id, payload=b''):
+        """Queue header and payload together (one syscall, one segment)"""
+        if payload:
+            # Vectored write: on Python 3.12+ the transport hands both buffers
+            # to sendmsg() without first copying the payload behind the header
+            transport.writelines((_pack_header(msg_type, msg_id, len(payload)), payload))
+        else:
+            transport.write(_pack_header(msg_type, msg_id, 0))
+
+def configure_logging(level=logging.INFO):
+    """Log through a queue so the event loop never blocks on console writes
+    
+    QueueHandler still formats each record on the logging thread; only the
+    stream write moves to the returned QueueListener's thread. Stop the
+    listener on shutdown to flush what is queued.
+    """
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
     
-    def recv_all(self, sock, length):
-        """Receive exactly 'length' bytes from the socket"""
-        data = b''
-        while len(data) < length:
-            chunk = sock.recv(length - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        return data
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+    return listener
 
 if __name__ == "__main__":
-    server = HyperTCPProtocolServer()
+    listener = configure_logging()
+    server = HyperTCPProtocolServer(unix_path=os.environ.get(UNIX_SOCKET_ENV))
     try:
-        server.start()
+        asyncio.run(server.start())
     except KeyboardInterrupt:
-        print("\nShutting down server...")
-        server.stop()
+        # start() stops the server as the loop shuts down
+        logger.info("Shutting down server...")
+    finally:
+        listener.stop()
@@ -5,13 +5,27 @@ This allows web browsers to communicate with the HyperTCP server
 """
 
 import asyncio
+import http
+import logging
+import logging.handlers
+import os
+import queue
 import websockets
 import socket
 import struct
 import json
-import threading
+import sys
 import time
 
+# The bridge only shuttles bytes between two sockets, so event loop overhead
+# dominates; run on uvloop's libuv loop when it is installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
 # HyperTCP protocol constants
 HYPER_TCP_CMD_RESPONSE      = 0
 HYPER_TCP_CMD_PING          = 6
@@ -25,168 +39,268 @@ HYPER_TCP_STATUS_INVALID_TOKEN     = 9
 HYPER_TCP_STATUS_NOT_AUTHENTICATED = 5
 HYPER_TCP_STATUS_TIMEOUT           = 16
 
-class HyperTCPHeader:
-    def __init__(self, type=0, msg_id=0, length=0):
-        self.type = type
-        self.msg_id = msg_id
-        self.length = length
-    
-    def pack(self):
-        return struct.pack('!BHH', self.type, self.msg_id, self.length)
-    
-    @classmethod
-    def unpack(cls, data):
-        type, msg_id, length = struct.unpack('!BHH', data)
-        return cls(type, msg_id, length)
+# Header layout: type (1 byte), message id (2 bytes), payload length (2 bytes)
+_HDR = struct.Struct('!BHH')
+# Largest HyperTCP frame; the web client sends one frame per message
+MAX_FRAME_SIZE = _HDR.size + 0xFFFF
+# Frames buffered per connection between the TCP reader and WebSocket sender
+FRAME_QUEUE_SIZE = 1024
+# Stop coalescing queued frames into one WebSocket message past this size
+WS_BATCH_SIZE = 64 * 1024
+# Kernel send/receive buffer size for the TCP server connection
+SOCKET_BUFFER_SIZE = 1 << 20
+# Seconds to wait for the TCP server before refusing the WebSocket upgrade
+TCP_CONNECT_TIMEOUT = 2.0
+# Set to the server's Unix socket path to reach it without loopback TCP
+UNIX_SOCKET_ENV = 'HYPERTCP_UNIX_SOCKET'
+
+def _header_tokens(headers, name):
+    """Lower-cased comma-separated tokens of every header called 'name'"""
+    return {token.strip().lower() for value in headers.get_all(name) for token in value.split(",")}
+
+def _is_websocket_upgrade(headers):
+    """True if the request headers ask for a WebSocket upgrade"""
+    return "upgrade" in _header_tokens(headers, "Connection") and "websocket" in _header_tokens(headers, "Upgrade")
 
 class WebSocketBridge:
-    def __init__(self, tcp_host='127.0.0.1', tcp_port=8080, ws_port=8081):
+    def __init__(self, tcp_host='127.0.0.1', tcp_port=8080, ws_port=8081, unix_path=None):
         self.tcp_host = tcp_host
         self.tcp_port = tcp_port
         self.ws_port = ws_port
-        self.tcp_socket = None
-        self.websocket = None
-        self.connected = False
-        
-    def connect_to_tcp_server(self):
-        """Connect to the HyperTCP server"""
+        self.unix_path = unix_path  # Dial the server's Unix socket instead of TCP
+        # TCP streams dialed during the handshake, until the handler takes them
+        self._pending_streams = {}
+        self._release_tasks = set()
+    
+    async def dial_tcp_server(self, connection, request):
+        """process_request hook: connect to the TCP server before accepting the upgrade"""
+        # Each WebSocket client gets its own TCP connection. If the server is
+        # unreachable the upgrade is refused with a 503.
+        if not _is_websocket_upgrade(request.headers):
+            # Plain HTTP requests (health checks, stray GETs) get the
+            # library's own error response without a HyperTCP connection
+            return None
         try:
-            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.tcp_socket.connect((self.tcp_host, self.tcp_port))
-            self.connected = True
-            print(f"Connected to HyperTCP server at {self.tcp_host}:{self.tcp_port}")
-            return True
-        except Exception as e:
-            print(f"Failed to connect to HyperTCP server: {e}")
-            return False
+            streams = await asyncio.wait_for(self._open_tcp_connection(), TCP_CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to connect to HyperTCP server: %r", e)
+            return connection.respond(http.HTTPStatus.SERVICE_UNAVAILABLE,
+                                      "Failed to connect to HyperTCP server\n")
+        logger.info("Connected to HyperTCP server at %s", self._server_address())
+        self._pending_streams[connection] = streams
+        
+        # The handshake can still fail after this hook, and then the handler
+        # never runs to take the streams; close them when the connection ends
+        task = asyncio.create_task(self._release_tcp_server(connection))
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_tasks.discard)
+        return None
     
-    def disconnect_from_tcp_server(self):
-        """Disconnect from the HyperTCP server"""
-        if self.tcp_socket:
-            try:
-                self.tcp_socket.close()
-            except:
-                pass
-            self.tcp_socket = None
-            self.connected = False
-            print("Disconnected from HyperTCP server")
+    async def _release_tcp_server(self, connection):
+        """Close TCP streams dialed for a connection that never reached the handler"""
+        await connection.wait_closed()
+        streams = self._pending_streams.pop(connection, None)
+        if streams:
+            streams[1].close()
     
     async def handle_websocket(self, websocket):
         """Handle WebSocket connection from web client"""
-        print(f"WebSocket client connected from {websocket.remote_address}")
-        self.websocket = websocket
+        logger.info("WebSocket client connected from %s", websocket.remote_address)
         
-        # Connect to TCP server
-        if not self.connect_to_tcp_server():
-            await websocket.close(code=1011, reason="Failed to connect to HyperTCP server")
-            return
-        
-        # Start TCP listener in a separate thread
-        tcp_listener_thread = threading.Thread(target=self.tcp_listener)
-        tcp_listener_thread.daemon = True
-        tcp_listener_thread.start()
+        # Dialed by dial_tcp_server; the state stays local to this handler,
+        # so concurrent clients never share it
+        reader, writer = self._pending_streams.pop(websocket)
         
+        # Forward TCP server frames to the WebSocket through a bounded queue:
+        # one task reads the TCP socket, the other sends on the WebSocket.
+        # The task group ties their lifetimes to this handler, so neither
+        # outlives the connection and a failure in one cancels the rest.
+        frames = asyncio.Queue(maxsize=FRAME_QUEUE_SIZE)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tcp_listener_task = tg.create_task(self.tcp_to_websocket(reader, frames))
+                ws_sender_task = tg.create_task(self.queue_to_websocket(frames, websocket))
+                await self.websocket_to_tcp(websocket, writer)
+                # The WebSocket is done; take the TCP side down with it
+                tcp_listener_task.cancel()
+                ws_sender_task.cancel()
+        finally:
+            # Clean up
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            logger.info("Disconnected from HyperTCP server")
+    
+    async def websocket_to_tcp(self, websocket, writer):
+        """Forward messages from the WebSocket to the TCP server until it closes"""
         try:
             # Handle messages from WebSocket
             async for message in websocket:
                 if isinstance(message, bytes):
                     # Binary message - forward to TCP server
-                    await self.forward_to_tcp(message)
+                    await self.forward_to_tcp(writer, websocket, message)
                 else:
-                    # Text message - ignore or handle as control message
-                    print(f"Received text message: {message}")
+                    # Text message - ignore; the HyperTCP path is binary only
+                    logger.debug("Received text message: %s", message)
         except websockets.exceptions.ConnectionClosed:
-            print("WebSocket connection closed")
+            logger.info("WebSocket connection closed")
         except Exception as e:
-            print(f"WebSocket error: {e}")
-        finally:
-            # Clean up
-            self.disconnect_from_tcp_server()
-            self.websocket = None
+            logger.warning("WebSocket error: %s", e)
+    
+    def _server_address(self):
+        """Where the HyperTCP server is dialed, for log messages"""
+        return self.unix_path or f"{self.tcp_host}:{self.tcp_port}"
     
-    async def forward_to_tcp(self, data):
+    async def _open_tcp_connection(self):
+        """Connect to the server (over its Unix socket if set) and wrap it in asyncio streams"""
+        if self.unix_path:
+            # Co-located server: no TCP options apply to a Unix socket
+            return await asyncio.open_unix_connection(self.unix_path)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Nagle off; buffers sized before connect() so the window scale covers them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, (self.tcp_host, self.tcp_port))
+            return await asyncio.open_connection(sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+    
+    async def forward_to_tcp(self, writer, websocket, data):
         """Forward data from WebSocket to TCP server"""
-        if self.tcp_socket and self.connected:
+        if not writer.is_closing():
             try:
-                self.tcp_socket.sendall(data)
+                # Each WebSocket message carries a whole frame (header and payload)
+                writer.write(data)
+                await writer.drain()
             except Exception as e:
-                print(f"Error forwarding to TCP server: {e}")
-                await self.websocket.close(code=1011, reason="TCP connection lost")
+                logger.warning("Error forwarding to TCP server: %s", e)
+                await websocket.close(code=1011, reason="TCP connection lost")
     
-    def tcp_listener(self):
-        """Listen for data from TCP server and forward to WebSocket"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        while self.connected and self.tcp_socket:
-            try:
+    async def tcp_to_websocket(self, reader, frames):
+        """Read frames from the TCP server into the bounded 'frames' queue"""
+        # Bind per-frame lookups once; the loop runs for every frame
+        readexactly = reader.readexactly
+        put = frames.put
+        header_size = _HDR.size
+        try:
+            while True:
                 # Read header first (5 bytes)
-                header_data = self.recv_all(5)
-                if not header_data:
-                    break
+                header_data = await readexactly(header_size)
+                
+                # Only the payload length matters here: the big-endian
+                # unsigned short in header bytes 3-4
+                length = (header_data[3] << 8) | header_data[4]
                 
-                # Forward header to WebSocket
-                asyncio.run_coroutine_threadsafe(
-                    self.websocket.send(header_data), 
-                    loop
-                )
+                # Read payload if any and queue the whole frame
+                if length > 0:
+                    payload_data = await readexactly(length)
+                    frame = header_data + payload_data
+                else:
+                    frame = header_data
                 
-                # Parse header to get payload length
-                header = HyperTCPHeader.unpack(header_data)
+                # Waits while the queue is full, so a stalled WebSocket peer
+                # stops us draining the socket and TCP flow control pushes
+                # back on the server
+                await put(frame)
+        except asyncio.IncompleteReadError:
+            # TCP server closed the connection
+            pass
+        except Exception as e:
+            logger.warning("Error in TCP listener: %s", e)
+        
+        # Tell the sender the TCP connection was lost
+        await frames.put(None)
+    
+    async def queue_to_websocket(self, frames, websocket):
+        """Send frames queued by tcp_to_websocket to the WebSocket"""
+        # Bind per-frame lookups once; the loop runs for every batch
+        get = frames.get
+        get_nowait = frames.get_nowait
+        empty = frames.empty
+        send = websocket.send
+        join = b''.join
+        try:
+            while True:
+                frame = await get()
+                if frame is None:
+                    break
                 
-                # Read payload if any
-                if header.length > 0:
-                    payload_data = self.recv_all(header.length)
-                    if not payload_data:
+                # Coalesce whatever else is already queued into the same
+                # WebSocket message: one WebSocket header and one drain for
+                # the batch. The web client splits it on the HyperTCP headers
+                batch = [frame]
+                total = len(frame)
+                while total < WS_BATCH_SIZE and not empty():
+                    frame = get_nowait()
+                    if frame is None:
                         break
-                    
-                    # Forward payload to WebSocket
-                    asyncio.run_coroutine_threadsafe(
-                        self.websocket.send(payload_data), 
-                        loop
-                    )
-                    
-            except Exception as e:
-                print(f"Error in TCP listener: {e}")
-                break
+                    batch.append(frame)
+                    total += len(frame)
+                
+                await send(batch[0] if len(batch) == 1 else join(batch))
+                if frame is None:
+                    break
+        except websockets.exceptions.ConnectionClosed:
+            # The WebSocket side is gone; handle_websocket cleans up
+            return
         
         # If we get here, the TCP connection was lost
-        if self.websocket:
-            asyncio.run_coroutine_threadsafe(
-                self.websocket.close(code=1011, reason="TCP connection lost"), 
-                loop
-            )
-    
-    def recv_all(self, length):
-        """Receive exactly 'length' bytes from the TCP socket"""
-        data = b''
-        while len(data) < length:
-            try:
-                chunk = self.tcp_socket.recv(length - len(data))
-                if not chunk:
-                    return None
-                data += chunk
-            except Exception as e:
-                print(f"Error receiving data: {e}")
-                return None
-        return data
+        await websocket.close(code=1011, reason="TCP connection lost")
     
     async def start(self):
         """Start the WebSocket server"""
-        print(f"Starting WebSocket bridge on port {self.ws_port}")
-        print(f"Will forward to HyperTCP server at {self.tcp_host}:{self.tcp_port}")
+        logger.info("Starting WebSocket bridge on port %s", self.ws_port)
+        logger.info("Will forward to HyperTCP server at %s", self._server_address())
         
-        # Create the server with the correct handler
-        server = await websockets.serve(self.handle_websocket, "0.0.0.0", self.ws_port)
+        # Create the server with the correct handler. The TCP server is dialed
+        # during the handshake. Frames are opaque binary, so permessage-deflate
+        # would only burn CPU compressing them.
+        server = await websockets.serve(
+            self.handle_websocket, "0.0.0.0", self.ws_port,
+            process_request=self.dial_tcp_server,
+            compression=None, max_size=MAX_FRAME_SIZE
+        )
         await server.wait_closed()
 
+def configure_logging(level=logging.INFO):
+    """Write log records to stdout from a QueueListener thread and return the listener"""
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+    return listener
+
 async def main():
     # Create bridge: WebSocket on port 8081 <-> TCP on port 8080
-    bridge = WebSocketBridge(tcp_host='127.0.0.1', tcp_port=8080, ws_port=8081)
+    bridge = WebSocketBridge(tcp_host='127.0.0.1', tcp_port=8080, ws_port=8081,
+                             unix_path=os.environ.get(UNIX_SOCKET_ENV))
     await bridge.start()
 
 if __name__ == "__main__":
+    listener = configure_logging()
+    if uvloop is None:
+        run = asyncio.run
+    elif hasattr(uvloop, 'run'):
+        run = uvloop.run
+    else:
+        # uvloop.run() arrived in 0.18; older releases install a loop policy
+        uvloop.install()
+        run = asyncio.run
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
-        print("\nShutting down WebSocket bridge...")
\ No newline at end of file
+        logger.info("Shutting down WebSocket bridge...")
+    finally:
+        listener.stop()
\ No newline at end of file